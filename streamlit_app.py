@@ -1,13 +1,18 @@
 import streamlit as st
 import streamlit.components.v1 as components
 import folium
+from streamlit_folium import st_folium
+from streamlit_autorefresh import st_autorefresh
 from datetime import datetime, timezone
 import time
-from collections import deque
-import random
-from math import radians, sin, cos, sqrt, atan2
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from math import radians, cos
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
 
 # Configuración de la página
 st.set_page_config(
@@ -16,320 +21,556 @@ st.set_page_config(
     layout="wide"
 )
 
+# Radio terrestre en millas náuticas
+R_NM = 6371000 / 1852
+# Segundos durante los que una posición descargada se considera vigente
+POSITION_TTL = 300
+# Margen para que el refresco del navegador, que se mide desde que se monta
+# el componente, no llegue unos segundos antes de que venza el TTL
+REFRESH_SLACK = 5
+
+# Headers que simulan un navegador real. Los comunes se fijan una vez en la
+# sesión; requests les añade los de página o API en cada petición
+_BASE_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Referer': 'https://share.garmin.com/'
+}
+_PAGE_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Upgrade-Insecure-Requests': '1',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'Sec-Fetch-User': '?1',
+    'Cache-Control': 'max-age=0'
+}
+_API_HEADERS = {
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'X-Requested-With': 'XMLHttpRequest'
+}
+
+# Plantilla del popup de cada barco
+_POPUP_TMPL = """
+            <div style="font-family: Arial, sans-serif; min-width: 200px;">
+                <h3 style="margin: 0 0 10px 0;">{name}</h3>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr><td><b>Última actualización:</b></td>
+                        <td>{time}</td></tr>
+                    <tr><td><b>Velocidad:</b></td>
+                        <td>{speed:.1f} nudos</td></tr>
+                    <tr><td><b>Rumbo:</b></td>
+                        <td>{course:.0f}°</td></tr>
+                    <tr><td><b>Posición:</b></td>
+                        <td>{lat:.4f}°, {lon:.4f}°</td></tr>
+                    <tr><td><b>Elevación:</b></td>
+                        <td>{elev:.1f} m</td></tr>
+                </table>
+            </div>
+        """
+
+def _as_number(value):
+    # Campos numéricos opcionales del feed: null o valores no numéricos
+    # cuentan como 0 para que el popup siempre pueda formatearse
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def _haversine_nm(lat1, lon1, lat2, lon2, cos_lat1=None):
+    # Distancia en millas náuticas entre coordenadas en radianes; acepta
+    # escalares o arrays de NumPy. cos_lat1 permite pasar el coseno ya
+    # calculado cuando el primer punto es fijo
+    if cos_lat1 is None:
+        cos_lat1 = np.cos(lat1)
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat/2)**2 + cos_lat1 * np.cos(lat2) * np.sin(dlon/2)**2
+    # asin(sqrt(a)) equivale a atan2(sqrt(a), sqrt(1-a)) con una raíz menos;
+    # el mínimo evita salir del dominio por redondeo cerca de las antípodas
+    return 2 * R_NM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
 class GarminShareTracker:
+    _COLORS = ('blue', 'red', 'green', 'purple', 'orange', 'darkred')
+
     def __init__(self, history_length=100):
         self.boats = {}
-        self.map = None
+        # Centro y zoom del mapa; el mapa de folium se construye en cada render
+        self.map_view = None
         self.history_length = history_length
-        self.colors = ['blue', 'red', 'green', 'purple', 'orange', 'darkred']
+        # Siguiente color de _COLORS; se recorre cíclicamente al añadir barcos
+        self._next_color_idx = 0
         self.noronha_coords = (-3.8547, -32.4248)
         self.radius_nm = 10
-        self.proximity_circle = None
-        self.last_update_time = {}
+        # Noronha es el ancla fija de todas las distancias: convertir una vez
+        self._nlat_r = radians(self.noronha_coords[0])
+        self._nlon_r = radians(self.noronha_coords[1])
+        self._cos_nlat = cos(self._nlat_r)
+        # Barco más cercano a Noronha: (nombre, posición, distancia) o None
+        self.proximity = None
+        # HTML de popups por (barco, timestamp, lat, lon); acotado a unas
+        # pocas entradas por barco
+        self._popup_cache = {}
+        # Última posición por share_id: (time.monotonic(), position_data)
+        self._cache = {}
+        # Shares cuya página principal ya se visitó en esta sesión HTTP
+        self._cookies_seeded = set()
+        # Shares con una descarga en curso, lanzada por cualquier sesión
+        self._in_flight = set()
+        # Hora de la última descarga correcta, ya formateada para mostrarla
+        self.last_update_str = None
+        # Últimas posiciones en un array (una fila por barco, en el orden de
+        # _names) para los cálculos en bloque; NaN = sin posición. _latlon
+        # guarda (lat, lon) ya en radianes. Se reservan filas de antemano y
+        # solo las primeras len(_names) son válidas
+        self._names = []
+        self._allocate_arrays(32)
+        # Alguna posición cambió desde el último cálculo de self.proximity
+        self._proximity_dirty = True
+        # Sesión compartida: reutiliza las conexiones TLS con share.garmin.com
+        # y reintenta con espera exponencial ante 429 y errores de pasarela
         self.session = requests.Session()
+        self.session.headers.update(_BASE_HEADERS)
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 503, 504])
+        )
+        self.session.mount('https://', adapter)
+        # Pool de hilos persistente para las descargas; se crea en la primera
+        # actualización, con un hilo por barco hasta el tamaño del pool HTTP
+        self._executor = None
+        # Protege la caché de posiciones, los shares visitados o en curso y
+        # los avisos pendientes, que se escriben desde los hilos de descarga
+        self._lock = threading.Lock()
+        self._notices = []
+        # Protege los datos que se dibujan (posiciones, históricos, popups y
+        # barco más cercano); nunca guarda objetos de folium
+        self.state_lock = threading.Lock()
         
     def nautical_miles_to_meters(self, nm):
         return nm * 1852
+
+    @property
+    def radius_nm(self):
+        return self._radius_nm
+
+    @radius_nm.setter
+    def radius_nm(self, value):
+        # El radio en metros solo cambia con radius_nm: se calcula aquí y no
+        # en cada render
+        self._radius_nm = value
+        self._radius_m = self.nautical_miles_to_meters(value)
     
-    def calculate_distance(self, lat1, lon1, lat2, lon2):
-        R = 6371000
-        lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-        distance_m = R * c
-        return distance_m / 1852
+    def _distance_from_noronha(self, lat, lon):
+        # lat/lon en radianes; Noronha y su coseno ya están precalculados
+        return _haversine_nm(self._nlat_r, self._nlon_r, lat, lon, cos_lat1=self._cos_nlat)
 
     def extract_share_id(self, garmin_url):
         return garmin_url.split('/')[-1]
     
     def add_boat(self, name, garmin_share_url):
-        color = random.choice(self.colors)
-        self.colors.remove(color)
+        color = self._COLORS[self._next_color_idx]
+        self._next_color_idx = (self._next_color_idx + 1) % len(self._COLORS)
         share_id = self.extract_share_id(garmin_share_url)
         self.boats[name] = {
             'share_id': share_id,
-            'marker': None,
-            'path': None,
             'color': color,
-            'history': deque(maxlen=self.history_length),
+            # Buffer circular de (lat, lon): hist_head es la próxima fila a
+            # escribir y hist_len las filas válidas
+            'history': np.empty((self.history_length, 2), dtype=np.float32),
+            'hist_head': 0,
+            'hist_len': 0,
             'last_update': None,
-            'cached_position': None,
-            'session': requests.Session()  # Sesión individual por barco
+            'index': len(self._names)
         }
-        self.last_update_time[name] = 0
+        if len(self._names) == len(self._latlon):
+            self._allocate_arrays(2 * len(self._latlon))
+        self._names.append(name)
+
+    def _allocate_arrays(self, capacity):
+        # Reserva (o amplía conservando los datos) el array de posiciones
+        n = len(self._names)
+        latlon = np.full((capacity, 2), np.nan)
+        if n:
+            latlon[:n] = self._latlon[:n]
+        self._latlon = latlon
+
+    def _notify(self, level, message):
+        # Streamlit solo puede llamarse desde el hilo principal: los hilos de
+        # descarga dejan aquí sus mensajes y update_positions los muestra
+        with self._lock:
+            self._notices.append((level, message))
+
+    def flush_notices(self):
+        with self._lock:
+            notices, self._notices = self._notices, []
+        for level, message in notices:
+            getattr(st, level)(message)
 
     def get_position(self, share_id, boat_name):
+        # Se ejecuta en un hilo del pool: no debe tocar st ni el mapa
+        # La edad de la posición se cuenta desde que empieza la descarga
+        started = time.monotonic()
+
+        # La página principal de cada share solo hace falta una vez para
+        # obtener sus cookies; después se va directo a la API
+        with self._lock:
+            seeded = share_id in self._cookies_seeded
+        if not seeded:
+            base_url = f"https://share.garmin.com/{share_id}"
+            response = self.session.get(base_url, headers=_PAGE_HEADERS, timeout=(3, 10))
+
+            if response.status_code == 200:
+                with self._lock:
+                    self._cookies_seeded.add(share_id)
+            else:
+                self._notify('warning', f"Error accediendo a la página principal de {boat_name}")
+
+        # Hacer la petición a la API; los 429 los reintenta el adaptador
+        position_url = f"https://share.garmin.com/Feed/Share/{share_id}"
+        response = self.session.get(position_url, headers=_API_HEADERS, timeout=(3, 10))
+
+        # Verificar el contenido de la respuesta
+        if response.status_code != 200:
+            self._notify('error', f"Error de servidor para {boat_name}: {response.status_code}")
+            return None
+
+        # Intentar decodificar la respuesta JSON
         try:
-            current_time = time.time()
-            # Usar caché si la última actualización fue hace menos de 5 minutos
-            if current_time - self.last_update_time.get(boat_name, 0) < 300:
-                boat_info = self.boats.get(boat_name)
-                if boat_info and boat_info.get('cached_position'):
-                    st.info(f"Usando datos en caché para {boat_name}")
-                    return boat_info['cached_position']
-
-            # Headers que simulan un navegador real
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-                'Accept-Language': 'en-US,en;q=0.9',
-                'Accept-Encoding': 'gzip, deflate, br',
-                'Connection': 'keep-alive',
-                'Upgrade-Insecure-Requests': '1',
-                'Sec-Fetch-Dest': 'document',
-                'Sec-Fetch-Mode': 'navigate',
-                'Sec-Fetch-Site': 'none',
-                'Sec-Fetch-User': '?1',
-                'Cache-Control': 'max-age=0',
-                'Referer': 'https://share.garmin.com/'
-            }
+            data = orjson.loads(response.content)
+        except orjson.JSONDecodeError:
+            self._notify('error', f"Respuesta no válida para {boat_name}: {response.content[:100].decode(errors='replace')}")
+            return None
 
-            # Usar la sesión específica del barco
-            session = self.boats[boat_name]['session']
+        if not data.get('locations'):
+            self._notify('error', f"No hay datos de posición para {boat_name}")
+            return None
 
-            # Primero, visitar la página principal del share
-            base_url = f"https://share.garmin.com/{share_id}"
-            response = session.get(base_url, headers=headers, timeout=10)
-            
-            if response.status_code != 200:
-                st.warning(f"Error accediendo a la página principal de {boat_name}")
-                time.sleep(5)
-            
-            # Esperar como lo haría un usuario real
-            time.sleep(2)
-
-            # Actualizar headers para la petición API
-            api_headers = headers.copy()
-            api_headers.update({
-                'Accept': 'application/json, text/javascript, */*; q=0.01',
-                'X-Requested-With': 'XMLHttpRequest'
-            })
-
-            # Hacer la petición a la API
-            position_url = f"https://share.garmin.com/Feed/Share/{share_id}"
-            response = session.get(position_url, headers=api_headers, timeout=10)
-
-            # Manejar límite de peticiones
-            if response.status_code == 429:
-                st.warning(f"Límite de peticiones alcanzado para {boat_name}. Esperando...")
-                time.sleep(120)
-                response = session.get(position_url, headers=api_headers, timeout=10)
-
-            # Verificar el contenido de la respuesta
-            if response.status_code != 200:
-                st.error(f"Error de servidor para {boat_name}: {response.status_code}")
-                return None
-
-            # Intentar decodificar la respuesta JSON
-            try:
-                data = response.json()
-            except json.JSONDecodeError:
-                st.error(f"Respuesta no válida para {boat_name}: {response.text[:100]}")
-                return None
-
-            if not data.get('locations'):
-                st.error(f"No hay datos de posición para {boat_name}")
-                return None
-
-            # Procesar los datos
-            location = data['locations'][0]
-            position_data = {
-                'lat': location.get('latitude'),
-                'lon': location.get('longitude'),
-                'timestamp': location.get('timestamp'),
-                'speed': location.get('speed', {}).get('value', 0),
-                'course': location.get('course', 0),
-                'elevation': location.get('elevation', {}).get('value', 0)
-            }
+        # Procesar los datos. Se validan aquí, antes de tocar la caché o el
+        # estado del tracker, porque luego van a arrays numéricos
+        location = data['locations'][0]
+        try:
+            lat = float(location['latitude'])
+            lon = float(location['longitude'])
+        except (KeyError, TypeError, ValueError):
+            self._notify('error', f"Posición no válida para {boat_name}")
+            return None
+        try:
+            timestamp = int(location['timestamp'])
+        except (KeyError, TypeError, ValueError):
+            timestamp = None
+        position_data = {
+            'lat': lat,
+            'lon': lon,
+            'timestamp': timestamp,
+            'speed': _as_number((location.get('speed') or {}).get('value')),
+            'course': _as_number(location.get('course')),
+            'elevation': _as_number((location.get('elevation') or {}).get('value'))
+        }
 
-            # Actualizar caché y tiempo
-            self.last_update_time[boat_name] = current_time
-            self.boats[boat_name]['cached_position'] = position_data
+        # Actualizar caché
+        with self._lock:
+            self._cache[share_id] = (started, position_data)
+            self.last_update_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-            return position_data
+        return position_data
 
+    def collect_position(self, boat_name, future):
+        # Recoge el resultado de get_position en el hilo principal
+        try:
+            return future.result()
         except requests.exceptions.Timeout:
             st.error(f"Timeout al obtener datos de {boat_name}")
             return None
         except Exception as e:
             st.error(f"Error obteniendo posición de {boat_name}: {str(e)}")
-            boat_info = self.boats.get(boat_name)
-            if boat_info and boat_info.get('cached_position'):
-                return boat_info['cached_position']
+            # La última posición ya está aplicada: devolverla la volvería a
+            # añadir al histórico
             return None
 
     def create_popup_content(self, boat_name, position):
+        # El timestamp puede faltar en el feed: la posición forma parte de la
+        # clave para no mostrar datos de otro punto
+        key = (boat_name, position.get('timestamp'), position['lat'], position['lon'])
+        cached = self._popup_cache.get(key)
+        if cached is not None:
+            return cached
+
         try:
-            timestamp = datetime.fromtimestamp(position['timestamp']/1000, timezone.utc)
+            # Garmin envía milisegundos
+            timestamp = datetime.fromtimestamp(position['timestamp'] * 1e-3, timezone.utc)
             local_time = timestamp.astimezone()
         except:
             local_time = datetime.now()
             
-        return f"""
-            <div style="font-family: Arial, sans-serif; min-width: 200px;">
-                <h3 style="margin: 0 0 10px 0;">{boat_name}</h3>
-                <table style="width: 100%; border-collapse: collapse;">
-                    <tr><td><b>Última actualización:</b></td>
-                        <td>{local_time.strftime('%Y-%m-%d %H:%M:%S')}</td></tr>
-                    <tr><td><b>Velocidad:</b></td>
-                        <td>{position['speed']:.1f} nudos</td></tr>
-                    <tr><td><b>Rumbo:</b></td>
-                        <td>{position['course']}°</td></tr>
-                    <tr><td><b>Posición:</b></td>
-                        <td>{position['lat']:.4f}°, {position['lon']:.4f}°</td></tr>
-                    <tr><td><b>Elevación:</b></td>
-                        <td>{position['elevation']:.1f} m</td></tr>
-                </table>
-            </div>
-        """
+        html = _POPUP_TMPL.format(
+            name=boat_name,
+            time=local_time.strftime('%Y-%m-%d %H:%M:%S'),
+            speed=position['speed'],
+            course=position['course'],
+            lat=position['lat'],
+            lon=position['lon'],
+            elev=position['elevation']
+        )
+        # Descartar la entrada más antigua al superar 8 por barco
+        if len(self._popup_cache) >= 8 * max(1, len(self.boats)):
+            self._popup_cache.pop(next(iter(self._popup_cache)))
+        self._popup_cache[key] = html
+        return html
 
     def find_closest_boat_to_noronha(self):
-        closest_boat = None
-        min_distance = float('inf')
-        closest_position = None
-        
-        for boat_name, boat_info in self.boats.items():
-            if boat_info['last_update']:
-                position = boat_info['last_update']
-                distance = self.calculate_distance(
-                    self.noronha_coords[0], self.noronha_coords[1],
-                    position['lat'], position['lon']
-                )
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_boat = boat_name
-                    closest_position = position
-        
-        return closest_boat, closest_position, min_distance
+        latlon = self._latlon[:len(self._names)]
+        if np.isnan(latlon[:, 0]).all():
+            return None, None, float('inf')
 
-    def update_proximity_circle(self):
-        if self.proximity_circle and self.map:
-            self.map.remove_layer(self.proximity_circle)
-            
+        # Haversine de todos los barcos contra Noronha en una sola pasada
+        distances = self._distance_from_noronha(latlon[:, 0], latlon[:, 1])
+        idx = np.nanargmin(distances)
+        closest_boat = self._names[idx]
+        return closest_boat, self.boats[closest_boat]['last_update'], float(distances[idx])
+
+    def update_proximity(self):
         closest_boat, position, distance = self.find_closest_boat_to_noronha()
-        
-        if closest_boat and position:
-            self.proximity_circle = folium.Circle(
+        self.proximity = (closest_boat, position, distance) if closest_boat and position else None
+
+    def is_fresh(self, boat_info):
+        # Posiciones de menos de 5 minutos no se vuelven a pedir a Garmin
+        with self._lock:
+            entry = self._cache.get(boat_info['share_id'])
+        return (bool(boat_info['last_update']) and entry is not None
+                and time.monotonic() - entry[0] < POSITION_TTL - REFRESH_SLACK)
+
+    def update_boat_position(self, boat_info, position):
+        if not position:
+            return False
+
+        idx = boat_info['index']
+        self._latlon[idx] = np.radians((position['lat'], position['lon']))
+
+        head = boat_info['hist_head']
+        boat_info['history'][head] = (position['lat'], position['lon'])
+        boat_info['hist_head'] = (head + 1) % self.history_length
+        boat_info['hist_len'] = min(boat_info['hist_len'] + 1, self.history_length)
+        boat_info['last_update'] = position
+        # Cualquier posición aplicada puede cambiar el barco más cercano,
+        # aunque el feed no traiga timestamp
+        self._proximity_dirty = True
+        return True
+
+    def history_points(self, boat_info):
+        # Puntos del buffer circular en orden cronológico
+        n = boat_info['hist_len']
+        history = boat_info['history']
+        if n < self.history_length:
+            return history[:n].tolist()
+        # Lleno: la fila más antigua es la siguiente a escribir
+        return np.roll(history, -boat_info['hist_head'], axis=0).tolist()
+
+    def initialize_map(self, center_lat=-5.0, center_lon=-35.0, zoom=6):
+        self.map_view = (center_lat, center_lon, zoom)
+
+    def snapshot(self):
+        # Copia de lo necesario para dibujar, tomada bajo state_lock: por
+        # barco (nombre, color, posición, popup, trayectoria) y la proximidad
+        with self.state_lock:
+            boats = []
+            for boat_name, boat_info in self.boats.items():
+                position = boat_info['last_update']
+                popup = self.create_popup_content(boat_name, position) if position else None
+                track = self.history_points(boat_info) if boat_info['hist_len'] > 1 else None
+                boats.append((boat_name, boat_info['color'], position, popup, track))
+            return boats, self.proximity
+
+    def build_map(self):
+        # Mapa y capas nuevos en cada render a partir de los datos guardados:
+        # st_folium añade los grupos al mapa y folium añade hijos a los
+        # marcadores al renderizar, así que reutilizar los objetos los haría
+        # crecer en cada rerun. Se construyen fuera del lock
+        boats, proximity = self.snapshot()
+        if self.map_view is None:
+            self.initialize_map()
+        center_lat, center_lon, zoom = self.map_view
+        folium_map = folium.Map(
+            location=[center_lat, center_lon],
+            zoom_start=zoom,
+            tiles='OpenStreetMap',
+            attr='Map data &copy; <a href="https://www.openstreetmap.org/">OpenStreetMap</a> contributors'
+        )
+
+        # El mapa base solo contiene elementos fijos, para que la clave del
+        # componente no cambie entre reruns
+        folium.Marker(
+            location=self.noronha_coords,
+            popup="Fernando de Noronha",
+            icon=folium.Icon(color='green', icon='info-sign')
+        ).add_to(folium_map)
+
+        # Barcos, trayectorias y círculo van en grupos aparte que st_folium
+        # sustituye en el navegador sin volver a crear el mapa de Leaflet
+        groups = []
+        for boat_name, color, position, popup, track in boats:
+            fg = folium.FeatureGroup(name=boat_name)
+            if position:
+                folium.Marker(
+                    location=[position['lat'], position['lon']],
+                    popup=folium.Popup(popup, max_width=300),
+                    icon=folium.Icon(color=color, icon='ship', prefix='fa')
+                ).add_to(fg)
+                if track:
+                    folium.PolyLine(
+                        locations=track,
+                        weight=3,
+                        color=color,
+                        opacity=0.8
+                    ).add_to(fg)
+            groups.append(fg)
+
+        fg = folium.FeatureGroup(name='proximidad')
+        if proximity:
+            closest_boat, position, distance = proximity
+            folium.Circle(
                 location=[position['lat'], position['lon']],
-                radius=self.nautical_miles_to_meters(self.radius_nm),
+                radius=self._radius_m,
                 color="red",
                 fill=True,
                 fillColor="red",
                 fillOpacity=0.2,
                 popup=f"Radio de {self.radius_nm}nm alrededor de {closest_boat}\n"
                       f"Distancia a Fernando de Noronha: {distance:.1f}nm"
-            )
-            self.proximity_circle.add_to(self.map)
-            
-            folium.Marker(
-                location=self.noronha_coords,
-                popup="Fernando de Noronha",
-                icon=folium.Icon(color='green', icon='info-sign')
-            ).add_to(self.map)
-
-    def update_boat_position(self, boat_name, boat_info):
-        position = self.get_position(boat_info['share_id'], boat_name)
-        
-        if position:
-            boat_info['history'].append([position['lat'], position['lon']])
-            boat_info['last_update'] = position
+            ).add_to(fg)
+        groups.append(fg)
+        return folium_map, groups
 
-            if boat_info['marker'] is not None:
-                self.map.remove_layer(boat_info['marker'])
-            if boat_info['path'] is not None:
-                self.map.remove_layer(boat_info['path'])
-
-            popup_content = self.create_popup_content(boat_name, position)
-            marker = folium.Marker(
-                location=[position['lat'], position['lon']],
-                popup=folium.Popup(popup_content, max_width=300),
-                icon=folium.Icon(color=boat_info['color'], icon='ship', prefix='fa')
-            )
-            marker.add_to(self.map)
-            boat_info['marker'] = marker
-
-            if len(boat_info['history']) > 1:
-                path = folium.PolyLine(
-                    locations=list(boat_info['history']),
-                    weight=3,
-                    color=boat_info['color'],
-                    opacity=0.8
+    def update_positions(self):
+        # Las descargas son independientes y limitadas por la red: lanzarlas
+        # en paralelo y sin state_lock, para que otras sesiones puedan seguir
+        # dibujando el mapa mientras tanto. Los barcos que otra sesión ya
+        # está descargando se omiten
+        stale = {name: info for name, info in self.boats.items()
+                 if not self.is_fresh(info)}
+        with self._lock:
+            stale = {name: info for name, info in stale.items()
+                     if info['share_id'] not in self._in_flight}
+            self._in_flight.update(info['share_id'] for info in stale.values())
+            if stale and self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=min(8, len(self.boats)), thread_name_prefix='garmin'
                 )
-                path.add_to(self.map)
-                boat_info['path'] = path
 
-    def initialize_map(self, center_lat=-5.0, center_lon=-35.0, zoom=6):
-        self.map = folium.Map(
-            location=[center_lat, center_lon],
-            zoom_start=zoom,
-            tiles='OpenStreetMap',
-            attr='Map data &copy; <a href="https://www.openstreetmap.org/">OpenStreetMap</a> contributors'
-        )
-
-    def update_positions(self):
-        if self.map is None:
-            self.initialize_map()
-            
-        for boat_name, boat_info in self.boats.items():
-            self.update_boat_position(boat_name, boat_info)
-        
-        self.update_proximity_circle()
-        
-        return self.map
+        results = []
+        try:
+            futures = {
+                self._executor.submit(self.get_position, info['share_id'], name): name
+                for name, info in stale.items()
+            }
+            for future in as_completed(futures):
+                boat_name = futures[future]
+                results.append((boat_name, self.collect_position(boat_name, future)))
+        finally:
+            with self._lock:
+                self._in_flight.difference_update(info['share_id'] for info in stale.values())
+        self.flush_notices()
+
+        # El tracker es compartido entre sesiones: las posiciones se aplican
+        # de una en una y sin que otra sesión esté copiando los datos
+        with self.state_lock:
+            for boat_name, position in results:
+                self.update_boat_position(self.boats[boat_name], position)
+
+            # Sin posiciones nuevas el barco más cercano no cambia
+            if self._proximity_dirty:
+                self._proximity_dirty = False
+                self.update_proximity()
 
 # Título de la aplicación
 st.title('🚢 Rastreador de Veleros')
 
-# Configuración de la sesión
-if 'last_update' not in st.session_state:
-    st.session_state.last_update = datetime.now()
-    st.session_state.tracker = GarminShareTracker()
+# Un único tracker por proceso: la sesión HTTP y los datos de los barcos se
+# comparten entre todas las sesiones de Streamlit; cada una construye su mapa
+@st.cache_resource
+def get_tracker():
+    tracker = GarminShareTracker()
     
     # Añadir los veleros
-    st.session_state.tracker.add_boat("Contessa", "https://share.garmin.com/contessa")
-    st.session_state.tracker.add_boat("Azuluc", "https://share.garmin.com/AZULUC")
-    st.session_state.tracker.add_boat("Finisterre", "https://share.garmin.com/FINISTERRE")
-    st.session_state.tracker.add_boat("Yorugua", "https://share.garmin.com/YoruguaSY")
+    tracker.add_boat("Contessa", "https://share.garmin.com/contessa")
+    tracker.add_boat("Azuluc", "https://share.garmin.com/AZULUC")
+    tracker.add_boat("Finisterre", "https://share.garmin.com/FINISTERRE")
+    tracker.add_boat("Yorugua", "https://share.garmin.com/YoruguaSY")
     
     # Inicializar mapa
-    st.session_state.tracker.initialize_map()
+    tracker.initialize_map()
+    return tracker
+
+tracker = get_tracker()
+
+# Configuración de la sesión
+if 'last_fetch' not in st.session_state:
+    st.session_state.last_fetch = None
+# Descarga pedida con el botón; no toca last_fetch para que el intervalo
+# siga alineado con st_autorefresh
+if 'force_fetch' not in st.session_state:
+    st.session_state.force_fetch = False
 
 # Crear columnas para organizar la interfaz
 col1, col2 = st.columns([4, 1])
 
 with col1:
     try:
-        # Mostrar el mapa
-        map_obj = st.session_state.tracker.update_positions()
-        st.components.v1.html(map_obj._repr_html_(), height=600)
+        # Solo volver a consultar Garmin si pasaron más de 5 minutos,
+        # independientemente de cuántas veces se re-ejecute el script
+        last_fetch = st.session_state.last_fetch
+        now = time.monotonic()
+        if last_fetch is None or now - last_fetch >= POSITION_TTL - REFRESH_SLACK:
+            # Marcar antes de descargar, igual que st_autorefresh cuenta su
+            # intervalo desde el inicio
+            st.session_state.last_fetch = now
+            st.session_state.force_fetch = False
+            tracker.update_positions()
+        elif st.session_state.force_fetch:
+            st.session_state.force_fetch = False
+            tracker.update_positions()
+
+        # Mostrar el mapa; los objetos de folium son propios de este render
+        map_obj, groups = tracker.build_map()
+        st_folium(
+            map_obj,
+            key='mapa',
+            height=600,
+            use_container_width=True,
+            feature_group_to_add=groups,
+            returned_objects=[]
+        )
     except Exception as e:
         st.error(f"Error al actualizar el mapa: {str(e)}")
 
 with col2:
     # Información y controles
     st.write("### Información")
-    st.write(f"Última actualización: {st.session_state.last_update.strftime('%Y-%m-%d %H:%M:%S')}")
+    # Hora de la última descarga real, aunque la hiciera otra sesión
+    st.write(f"Última actualización: {tracker.last_update_str or 'sin datos'}")
     
-    # Botón de actualización manual
+    # Botón de actualización manual: salta el intervalo de la sesión; is_fresh
+    # sigue evitando volver a pedir barcos con posición reciente
     if st.button('Actualizar Posiciones'):
         try:
-            st.session_state.last_update = datetime.now()
+            st.session_state.force_fetch = True
             st.rerun()
         except Exception as e:
             st.error(f"Error al actualizar: {str(e)}")
 
     # Mostrar leyenda de barcos
     st.write("### Barcos")
-    for name, info in st.session_state.tracker.boats.items():
+    for name, info in tracker.boats.items():
         st.markdown(f"* <span style='color: {info['color']}'>{name}</span>", unsafe_allow_html=True)
 
-# Actualización menos frecuente y mostrar tiempo restante
-if (datetime.now() - st.session_state.last_update).seconds > 600:  # 10 minutos
-    st.session_state.last_update = datetime.now()
-    st.rerun()
+# Re-ejecutar cada 5 minutos desde el navegador, sin bloquear el servidor
+st_autorefresh(interval=POSITION_TTL * 1000, key='boatrefresh')
 
-tiempo_restante = 600 - (datetime.now() - st.session_state.last_update).seconds
+# Mostrar tiempo restante con el reloj monotónico, sin crear datetimes
+last_fetch = st.session_state.last_fetch
+elapsed = int(time.monotonic() - last_fetch) if last_fetch is not None else POSITION_TTL
+tiempo_restante = max(0, POSITION_TTL - elapsed)
 st.write(f"Próxima actualización en: {tiempo_restante//60} minutos y {tiempo_restante%60} segundos")